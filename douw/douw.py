@@ -2,19 +2,29 @@
 
 import argparse
 import time
-import datetime
 import os
 import sys
-import subprocess
 import fnmatch
-import shutil
+import re
 
-import sqlite3
-
-from douw.site import Site
 from douw.version import __version__
 
-currentTime = str(time.time())
+SCHEMA_VERSION = 3
+
+SITE_SELECT_SQL = 'SELECT name, remote, env, default_treeish FROM site LIMIT 1'
+
+COMMIT_ID_RE = re.compile('[0-9a-fA-F]{7,40}')
+
+# Escape codes for highlighting output; left empty when the output does not go to a terminal.
+if sys.stdout.isatty():
+    RED, GREEN, YELLOW, GREY, RESET = '\033[31;1m', '\033[32;1m', '\033[33;1m', '\033[37m', '\033[0m'
+else:
+    RED = GREEN = YELLOW = GREY = RESET = ''
+
+# Listing row templates; the column widths are filled in first, producing the format for the rows themselves.
+SITE_LISTING_FORMAT = '{{:<{env_width}}} | {{:<{name_width}}} | {{:<{remote_width}}} | {{:<{default_treeish_width}}}'
+DEP_LISTING_FORMAT = '{{}} | {{:<{path_width}}} | {{:<{date_width}}} | {{:<{rev_width}}}'
+VAR_LISTING_FORMAT = '{{:<{name_width}}} | {{:<{value_width}}}'
 
 assume_yes = False
 
@@ -85,6 +95,9 @@ def create_add_parser(subparsers):
 
     populate_add_edit_parser(add_parser)
 
+    add_parser.add_argument('--from-file', metavar='PATH',
+                            help='read missing properties from a JSON file with name, remote, branch, and env keys')
+
 
 def create_edit_parser(subparsers):
     edit_parser = subparsers.add_parser('edit', help='edit a site', description='modify site properties')
@@ -177,16 +190,23 @@ def main():
     args.action(args)
 
 
-def init_db(db):
+def init_db(conn):
     """
     Initializes the given database for use.
 
     This creates the base schema and applies migrations if necessary.
+    Databases that are already at the current schema version are left untouched.
 
-    :param db: the database to initialize
+    :param conn: a connection to the database to initialize
     """
 
-    db.executescript("""
+    ver = conn.execute('PRAGMA user_version').fetchone()[0]
+
+    if ver >= SCHEMA_VERSION:
+        return
+
+    # Versions 2 and 3 only add tables and indices, which the script below creates if they are missing.
+    script = """
 CREATE TABLE IF NOT EXISTS site (
     name TEXT PRIMARY KEY NOT NULL,
     remote TEXT NOT NULL,
@@ -206,16 +226,35 @@ CREATE TABLE IF NOT EXISTS variable (
     id INTEGER PRIMARY KEY NOT NULL,
     name TEXT NOT NULL UNIQUE ON CONFLICT REPLACE,
     value TEXT NOT NULL
-)
-""")
+);
 
-    db.execute('PRAGMA user_version')
-    ver = db.fetchone()[0]
+CREATE INDEX IF NOT EXISTS idx_deployment_active_present_date ON deployment (active, present, date DESC);
+"""
 
     if ver < 1:
-        db.execute('ALTER TABLE site ADD COLUMN default_treeish TEXT')
+        script += 'ALTER TABLE site ADD COLUMN default_treeish TEXT;\n'
+
+    script += 'PRAGMA user_version = {};\n'.format(SCHEMA_VERSION)
 
-    db.execute('PRAGMA user_version = 1')
+    conn.executescript(script)
+
+
+def configure_db(conn):
+    """
+    Configures a freshly opened database connection.
+
+    The journal is switched to WAL with relaxed syncing, which saves several fsyncs per commit.
+
+    :param conn: the connection to configure
+    """
+    import sqlite3
+
+    conn.row_factory = sqlite3.Row
+
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA mmap_size = 268435456')
 
 
 def get_site_db(basedir, name):
@@ -229,47 +268,67 @@ def get_site_db(basedir, name):
     return os.path.join(basedir, name, 'site.db')
 
 
-def open_site_db(basedir, name, must_exist=True):
+def open_site_db(basedir, name):
     """
-    Opens a connection to a site's database.
+    Opens a connection to an existing site's database.
 
-    The database is checked for existence and R/W rights if the database is assumed to exist.
-    If the database is missing or cannot be modified, an error is raised (if must_exist is True) or the database is
-    created and initialized (if must_exist is False).
+    The database is checked for existence and R/W rights. If the database is missing or cannot be modified, an error
+    is raised.
 
-    Upon successfully opening the database migrations are applied transparently.
+    Upon successfully opening the database migrations are applied transparently; init_db returns early for databases
+    that are already up to date.
 
     :param basedir: the directory all sites are stored in
     :param name: the name of the site
-    :param must_exist: iff True, the file is checked for existence before attempting to open the database
 
     :return: a connection to the site's database
     """
+    import sqlite3
+
     db_path = get_site_db(basedir, name)
 
-    if must_exist and not os.access(db_path, os.F_OK):
-        raise FileNotFoundError('The requested site could not be found at {}'.format(os.path.join(basedir, name)))
+    # Only tell a missing database apart from an inaccessible one when the access check fails
+    if not os.access(db_path, os.W_OK | os.R_OK):
+        if not os.access(db_path, os.F_OK):
+            raise FileNotFoundError('The requested site could not be found at {}'.format(os.path.join(basedir, name)))
 
-    if must_exist and not os.access(db_path, os.W_OK | os.R_OK):
         raise PermissionError('You do not have the permission to access {}'.format(os.path.join(basedir, name)))
 
     conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+    configure_db(conn)
 
-    cur = conn.cursor()
-    init_db(cur)
-    cur.close()
-    conn.commit()
+    init_db(conn)
+
+    return conn
+
+
+def create_site_db(basedir, name):
+    """
+    Creates and initializes a site's database.
+
+    If the database already exists, it is opened and migrated like open_site_db would.
+
+    :param basedir: the directory all sites are stored in
+    :param name: the name of the site
+
+    :return: a connection to the site's database
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(get_site_db(basedir, name))
+    configure_db(conn)
+
+    init_db(conn)
 
     return conn
 
 
-def get_site_info(db):
-    db.execute('SELECT site.name, site.remote, site.env, site.default_treeish FROM site;')
-    site_info = db.fetchone()
+def get_site_info(conn):
+    from douw.site import Site
 
-    db.execute('SELECT revision, path FROM deployment WHERE active = 1;')
-    rev_info = db.fetchone() or {'revision': None, 'path': None}
+    site_info = conn.execute(SITE_SELECT_SQL).fetchone()
+    rev_info = conn.execute('SELECT revision, path FROM deployment WHERE active = 1;').fetchone()
+    rev_info = rev_info or {'revision': None, 'path': None}
 
     return Site(
         site_info['name'], site_info['remote'], site_info['env'], site_info['default_treeish'],
@@ -281,117 +340,130 @@ def accessible_sites(basedir):
     """
     A generator yielding all sites accessible by the current user.
 
+    Each site's connection is closed before the site is yielded.
+
     :param basedir: the directory all sites are stored in
     """
-    for ent in os.scandir(basedir):
-        ent_db = get_site_db(basedir, ent.name)
-        if os.access(ent_db, os.R_OK | os.W_OK):
-            conn = sqlite3.connect(ent_db)
-            conn.row_factory = sqlite3.Row
-            db = conn.cursor()
-            init_db(db)
+    import sqlite3
 
-            db.execute('SELECT name, remote, env, default_treeish FROM site;')
+    with os.scandir(basedir) as entries:
+        names = [ent.name for ent in entries if ent.is_dir()]
 
-            yield db.fetchone()
+    for name in names:
+        ent_db = get_site_db(basedir, name)
+        if not os.access(ent_db, os.R_OK | os.W_OK):
+            continue
+
+        conn = sqlite3.connect(ent_db)
+        try:
+            configure_db(conn)
+            init_db(conn)
 
+            site = dict(conn.execute(SITE_SELECT_SQL).fetchone())
+        finally:
             conn.close()
 
+        yield site
+
 
 def list(args):
-    sites = [*accessible_sites(args.basedir)]
+    name_re = re.compile(fnmatch.translate(args.site))
+    remote_re = re.compile(fnmatch.translate(args.remote))
 
-    # For each column, find the longest string.
+    # Keep the matching sites and find the longest string for each column in a single pass.
     lengths = {'env': 3, 'name': 4, 'remote': 6, 'default_treeish': max(len('(repo default)'), len('default branch'))}
-    for site in sites:
-        if not (fnmatch.fnmatch(site['name'], args.site) and fnmatch.fnmatch(site['remote'], args.remote)):
+    matched = []
+    for site in accessible_sites(args.basedir):
+        if not (name_re.match(site['name']) and remote_re.match(site['remote'])):
             continue
 
-        for column in site.keys():
-            lengths[column] = max(lengths[column], len(site[column] or ''))
+        lengths['env'] = max(lengths['env'], len(site['env'] or ''))
+        lengths['name'] = max(lengths['name'], len(site['name'] or ''))
+        lengths['remote'] = max(lengths['remote'], len(site['remote'] or ''))
+        lengths['default_treeish'] = max(lengths['default_treeish'], len(site['default_treeish'] or ''))
 
-    print_site_listing(lengths, {'env': 'env', 'name': 'site', 'remote': 'remote', 'default_treeish': 'default branch'})
+        matched.append(site)
 
-    for site in sites:
-        if not (fnmatch.fnmatch(site['name'], args.site) and fnmatch.fnmatch(site['remote'], args.remote)):
-            continue
+    # Substitute the widths once, so only the values remain to be formatted for each row.
+    listing_format = SITE_LISTING_FORMAT.format(
+        env_width=lengths['env'],
+        name_width=lengths['name'],
+        remote_width=lengths['remote'],
+        default_treeish_width=lengths['default_treeish']
+    )
+
+    print_site_listing(listing_format, {
+        'env': 'env', 'name': 'site', 'remote': 'remote', 'default_treeish': 'default branch'
+    })
 
-        print_site_listing(lengths, site)
+    for site in matched:
+        print_site_listing(listing_format, site)
 
 
-def print_site_listing(lengths, site):
-    print("{:<{env_width}} | {:<{name_width}} | {:<{remote_width}} | {:<{default_treeish_width}}".format(
+def print_site_listing(listing_format, site):
+    print(listing_format.format(
         site['env'],
         site['name'],
         site['remote'],
-        site['default_treeish'] or '\033[37m(repo default)\033[0m',
-        env_width=lengths['env'],
-        name_width=lengths['name'],
-        remote_width=lengths['remote'],
-        default_treeish_width=lengths['default_treeish']
+        site['default_treeish'] or GREY + '(repo default)' + RESET
     ))
 
 
 def deps(args):
     conn = open_site_db(args.basedir, args.site)
-    db = conn.cursor()
 
-    db.execute("""
-        SELECT deployment.path, deployment.date, deployment.active, deployment.revision, deployment.present
+    # Let SQLite format the dates and find the widest value in each column, so the rows can be printed as they are read.
+    widths = conn.execute("""
+        SELECT MAX(LENGTH(path)),
+               MAX(LENGTH(strftime('%Y-%m-%dT%H:%M:%S', date, 'unixepoch'))),
+               MAX(LENGTH(revision))
           FROM deployment
-          ORDER BY date;
-    """)
-
-    dbDeployments = db.fetchall()
-    deployments = []
-
-    # Translate each timestamp into a date and calculate the required column widths.
-    lengths = {'active': 1, 'path': 4, 'date': 4, 'revision': 6, 'present': 0}
-    for dbDep in dbDeployments:
-        deployment = {}
-
-        for column in dbDep.keys():
-            deployment[column] = dbDep[column]
+          WHERE present = 1 OR ? = 1;
+    """, (args.deleted,)).fetchone()
 
-        deployment['date'] = datetime.datetime.utcfromtimestamp(int(dbDep['date'])).isoformat()
+    lengths = {'path': max(4, widths[0] or 0), 'date': max(4, widths[1] or 0), 'revision': max(6, widths[2] or 0)}
 
-        for column in dbDep.keys():
-            if column == 'active':
-                continue
-
-            lengths[column] = max(lengths[column], len(str(deployment[column])))
-
-        deployments.append(deployment)
+    listing_format = DEP_LISTING_FORMAT.format(
+        path_width=lengths['path'],
+        date_width=lengths['date'],
+        rev_width=lengths['revision']
+    )
 
-    print_dep_listing(lengths, {
+    print_dep_listing(listing_format, {
         'active': True, 'path': 'path', 'date': 'date', 'revision': 'commit', 'present': True
     })
 
+    deployments = conn.execute("""
+        SELECT path, strftime('%Y-%m-%dT%H:%M:%S', date, 'unixepoch') AS date, active, revision, present
+          FROM deployment
+          WHERE present = 1 OR ? = 1
+          ORDER BY deployment.date;
+    """, (args.deleted,))
+
     for deployment in deployments:
-        if deployment['present'] or args.deleted:
-            print_dep_listing(lengths, deployment)
+        print_dep_listing(listing_format, deployment)
 
     conn.close()
 
 
-def print_dep_listing(lengths, dep):
-    print("{} | {:<{path_width}} | {:<{date_width}} | {:<{rev_width}}".format(
+def print_dep_listing(listing_format, dep):
+    print(listing_format.format(
         ('*' if dep['active'] else 'D' if not dep['present'] else ' '),
         dep['path'],
         dep['date'],
-        dep['revision'],
-        path_width=lengths['path'],
-        date_width=lengths['date'],
-        rev_width=lengths['revision']
+        dep['revision']
     ))
 
 
 def add(args):
+    if args.from_file is not None:
+        load_site_file(args, args.from_file)
+
     site_name = args.name or prompt_nonempty('Site name')
     site_dir = os.path.join(args.basedir, site_name)
 
     if os.access(get_site_db(args.basedir, site_name), os.F_OK):
-        print('\033[31;1mA site named {} already exists at {}\033[0m'.format(site_name, site_dir))
+        print(RED + 'A site named {} already exists at {}'.format(site_name, site_dir) + RESET)
         if args.force_dangerous:
             setattr(args, 'site', site_name)
             remove(args)
@@ -406,27 +478,55 @@ def add(args):
 
     os.makedirs(site_dir, mode=0o0775, exist_ok=True)
 
-    conn = open_site_db(args.basedir, site_name, must_exist=False)
-    db = conn.cursor()
+    conn = create_site_db(args.basedir, site_name)
 
-    db.execute('INSERT INTO site (name, remote, env, default_treeish) VALUES (?, ?, ?, ?)',
-               (site_name, remote, env, branch))
+    conn.execute('INSERT INTO site (name, remote, env, default_treeish) VALUES (?, ?, ?, ?)',
+                 (site_name, remote, env, branch))
 
     conn.commit()
     conn.close()
 
 
+def load_site_file(args, path):
+    """
+    Fills in site properties from a JSON file.
+
+    Properties given on the command line take precedence over the ones in the file.
+
+    :param args: the command line arguments to fill in
+    :param path: the path to the file
+    """
+    import json
+
+    with open(path, 'rt') as site_file:
+        properties = json.loads(site_file.read())
+
+    if not isinstance(properties, dict):
+        raise Exception('Expected an object with site properties in {}'.format(path))
+
+    unknown = set(properties) - {'name', 'remote', 'branch', 'env'}
+    if unknown:
+        raise Exception('Unknown site properties in {}: {}'.format(path, ', '.join(sorted(unknown))))
+
+    invalid = [key for key, value in properties.items() if value is not None and not isinstance(value, str)]
+    if invalid:
+        raise Exception('Site properties must be strings or null in {}: {}'.format(path, ', '.join(sorted(invalid))))
+
+    for key, value in properties.items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+
+
 def edit(args):
     site_name = args.site
 
     conn = open_site_db(args.basedir, site_name)
-    db = conn.cursor()
 
-    site_info = get_site_info(db)
+    site_info = get_site_info(conn)
 
     if args.name:
-        print('\033[31;1mThe site name will be changed to {}. Note that the directory name does not change, ask your '
-              'administrator or move the directory yourself.\033[0m'.format(args.name))
+        print(RED + 'The site name will be changed to {}. Note that the directory name does not change, ask your '
+              'administrator or move the directory yourself.'.format(args.name) + RESET)
         site_info.name = args.name
 
     if args.remote:
@@ -438,8 +538,8 @@ def edit(args):
     if args.env:
         site_info.env = args.env
 
-    db.execute('UPDATE site SET name = ?, remote = ?, env = ?, default_treeish = ? WHERE name = ?',
-               (site_info.name, site_info.remote, site_info.env, site_info.default_treeish, site_name)
+    conn.execute('UPDATE site SET name = ?, remote = ?, env = ?, default_treeish = ? WHERE name = ?',
+                 (site_info.name, site_info.remote, site_info.env, site_info.default_treeish, site_name)
     )
 
     conn.commit()
@@ -463,11 +563,10 @@ def prompt_nonempty(prompt):
     if assume_yes:
         raise Exception('Missing required value "{}"'.format(prompt))
 
-    value = input(prompt + ': ')
-    if value:
-        return value
-
-    return prompt_nonempty(prompt)
+    while True:
+        value = input(prompt + ': ')
+        if value:
+            return value
 
 
 def prompt_bool(prompt):
@@ -485,38 +584,114 @@ def prompt_bool(prompt):
 
 
 def fetch_from_cwd(args, deploy_dir):
+    import subprocess
+
     subprocess.run(['rsync', '-rlp', '--info=progress2', args.copy_from, deploy_dir], check=True)
     return 'file://{}#{}'.format(os.getcwd(), time.time())
 
 
-def fetch_from_git(args, db, site_info, deploy_dir):
-    subprocess.run(['git', 'clone', site_info.remote, deploy_dir + '/'], check=True)
+def fetch_from_git(args, conn, site_info, deploy_dir):
+    import subprocess
+    import shutil
+
+    # Only the deployed revision is needed, so skip the history and other branches.
     branch = args.treeish or site_info.default_treeish
-    if branch is not None:
+    if branch is None:
+        subprocess.run(['git', 'clone', '--depth=1', '--single-branch', site_info.remote, deploy_dir + '/'], check=True)
+    elif is_remote_ref(site_info.remote, branch):
+        subprocess.run(['git', 'clone', '--depth=1', '--single-branch', '--branch', branch,
+                        site_info.remote, deploy_dir + '/'], check=True)
+    else:
+        # --branch only accepts branches and tags; other tree-ishes such as commits need a full clone.
+        subprocess.run(['git', 'clone', site_info.remote, deploy_dir + '/'], check=True)
         subprocess.run(['git', '-C', deploy_dir, 'checkout', branch], check=True)
-    result = subprocess.run(['git', 'rev-parse', 'HEAD'],
-                            stdout=subprocess.PIPE, check=True, cwd=deploy_dir)
-    rev_id = result.stdout.decode('utf8').partition("\n")[0]
+    rev_id = read_head(deploy_dir)
 
-    db.execute('SELECT 1 FROM deployment WHERE revision = ? AND present = 1;', (rev_id,))
-    existing_deployment = db.fetchone()
+    existing_deployment = conn.execute('SELECT 1 FROM deployment WHERE revision = ? AND present = 1;',
+                                       (rev_id,)).fetchone()
     if existing_deployment is not None and args.force_useless is False and args.force_dangerous is False:
-        print('\033[31;1mThis revision ({}) was already deployed\033[0m'.format(rev_id))
+        print(RED + 'This revision ({}) was already deployed'.format(rev_id) + RESET)
         shutil.rmtree(deploy_dir)
-        db.connection.close()
 
         if args.revert:
-            print('\033[33;1mReverting to previous deployment\033[0m')
-            activate(args, site_info.name, rev_id)
+            print(YELLOW + 'Reverting to previous deployment' + RESET)
+            activate(args, site_info, rev_id, conn)
 
         return None
 
     return rev_id
 
 
-def fetch_files(args, db, site_info, deploy_dir):
+def is_remote_ref(remote, treeish):
+    """
+    Checks whether a tree-ish names a branch or tag in a remote repository.
+
+    Tree-ishes that look like (abbreviated) commit IDs are assumed to be commits without asking the remote.
+
+    :param remote: the URL of the remote repository
+    :param treeish: the tree-ish to check
+    :return: True iff the tree-ish is a branch or tag in the remote repository
+    """
+    import subprocess
+
+    if COMMIT_ID_RE.fullmatch(treeish):
+        return False
+
+    # ls-remote exits with 2 if nothing matches; anything else besides success is a genuine error
+    result = subprocess.run(['git', 'ls-remote', '--exit-code', '--heads', '--tags', remote, treeish],
+                            stdout=subprocess.DEVNULL)
+    if result.returncode == 2:
+        return False
+
+    result.check_returncode()
+    return True
+
+
+def read_head(repo_dir):
+    """
+    Returns the commit checked out in a git working tree.
+
+    The commit is read from the repository's HEAD and ref files, which saves spawning git. Should the refs not be
+    readable directly (e.g. because a different ref storage is used), git rev-parse is used instead.
+
+    :param repo_dir: the root of the working tree
+    :return: the ID of the checked out commit
+    """
+    git_dir = os.path.join(repo_dir, '.git')
+
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'rt') as head_file:
+            head = head_file.read().strip()
+
+        # A detached HEAD contains the commit itself
+        if not head.startswith('ref: '):
+            return head
+
+        ref = head[len('ref: '):]
+
+        try:
+            with open(os.path.join(git_dir, ref), 'rt') as ref_file:
+                return ref_file.read().strip()
+        except FileNotFoundError:
+            pass
+
+        with open(os.path.join(git_dir, 'packed-refs'), 'rt') as packed_refs_file:
+            for line in packed_refs_file:
+                commit, _, name = line.rstrip('\n').partition(' ')
+                if name == ref:
+                    return commit
+    except OSError:
+        pass
+
+    import subprocess
+
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, check=True, cwd=repo_dir)
+    return result.stdout.decode('utf8').partition("\n")[0]
+
+
+def fetch_files(args, conn, site_info, deploy_dir):
     if args.copy_from is None:
-        return fetch_from_git(args, db, site_info, deploy_dir)
+        return fetch_from_git(args, conn, site_info, deploy_dir)
     else:
         return fetch_from_cwd(args, deploy_dir)
 
@@ -538,38 +713,41 @@ def deploy(args):
     site_name = args.site
 
     conn = open_site_db(args.basedir, site_name)
-    db = conn.cursor()
 
-    site_info = get_site_info(db)
+    site_info = get_site_info(conn)
     site_dir = os.path.join(args.basedir, site_name)
 
-    deploy_dir = os.path.join(site_dir, 'deployments', currentTime)
+    current_time = format(time.time(), '.6f')
+    deploy_dir = os.path.join(site_dir, 'deployments', current_time)
 
-    print("\033[32;1mDeploying " + site_name + ".\033[0m")
+    print(GREEN + 'Deploying ' + site_name + '.' + RESET)
 
     os.makedirs(deploy_dir, mode=0o755, exist_ok=True)
 
-    rev_id = fetch_files(args, db, site_info, deploy_dir)
+    rev_id = fetch_files(args, conn, site_info, deploy_dir)
     if rev_id is None:
+        conn.close()
         return
 
-    print('\u001B[32;1mFound revision {}.\u001B[0m'.format(rev_id))
+    print(GREEN + 'Found revision {}.'.format(rev_id) + RESET)
 
     # Execute post-clone
-    run_script(db, deploy_dir, site_info.name, site_info.env, rev_id, 'post-clone')
+    run_script(conn, deploy_dir, site_info.name, site_info.env, rev_id, 'post-clone')
 
-    db.execute('INSERT INTO deployment (path, revision, date, active) VALUES (?, ?, ?, 0);',
-               (deploy_dir, rev_id, int(time.time())))
+    conn.execute('INSERT INTO deployment (path, revision, date, active) VALUES (?, ?, ?, 0);',
+                 (deploy_dir, rev_id, int(time.time())))
 
     conn.commit()
-    conn.close()
 
-    activate(args, site_info, rev_id)
+    # Activating and cleaning share the connection instead of reopening the database
+    activate(args, site_info, rev_id, conn)
+
+    clean(args, conn)
 
-    clean(args)
+    conn.close()
 
 
-def activate(args, site_info, revision):
+def activate(args, site_info, revision, conn=None):
     """
     Activates an existing deployment.
 
@@ -579,124 +757,164 @@ def activate(args, site_info, revision):
     :param args: command line arguments containing global settings
     :param site: the site to activate the deployment for
     :param revision: the revision ID indicating the deployment to activate
+    :param conn: an open connection to the site's database, or None to open (and close) one
     :return:
     """
     site_name = site_info.name
-    conn = open_site_db(args.basedir, site_name)
-    db = conn.cursor()
+
+    close_conn = conn is None
+    if close_conn:
+        conn = open_site_db(args.basedir, site_name)
 
     site_dir = os.path.join(args.basedir, site_name)
     link_name = os.path.join(site_dir, 'current')
-    new_link_name = link_name + '.new'
 
     # Find the directory the deployment is in
-    db.execute('SELECT path FROM deployment WHERE revision = ? AND present = 1 ORDER BY date DESC LIMIT 1', (revision,))
-    path_info = db.fetchone()
+    path_info = conn.execute(
+        'SELECT path FROM deployment WHERE revision = ? AND present = 1 ORDER BY date DESC LIMIT 1', (revision,)
+    ).fetchone()
     if path_info is None:
         raise Exception('No available deployment for revision {} for site {}'.format(revision, site_name))
 
-    # Check that the directory actually exists
     new_path = path_info['path']
     old_path = site_info.cur_path
-    if not os.path.exists(new_path):
-        db.execute('UPDATE deployment SET present = 0 WHERE path = ?', (new_path,))
-        conn.commit()
-        conn.close()
-        raise Exception('The selected revision ({}) has been removed'.format(revision))
 
     # Determine the location for the shared data
     shared_dir = os.path.join(site_dir, 'shared')
     shared_link_name = os.path.join(new_path, 'shared')
-    new_shared_link_name = shared_link_name + '.new'
 
-    # Switch the symlink to shared data, if the folder is present
-    if os.path.exists(shared_dir):
-        os.symlink(shared_dir, new_shared_link_name, target_is_directory=True)
-        os.replace(new_shared_link_name, shared_link_name)
+    # Switch the symlink to shared data, if the folder is present. Creating the link inside the deployment doubles as
+    # the check that the deployment still exists; without shared data the deployment is checked on its own.
+    try:
+        if os.path.isdir(shared_dir):
+            replace_symlink(shared_dir, shared_link_name)
+        else:
+            os.stat(new_path)
+    except FileNotFoundError:
+        conn.execute('UPDATE deployment SET present = 0 WHERE path = ?', (new_path,))
+        conn.commit()
+        if close_conn:
+            conn.close()
+        raise Exception('The selected revision ({}) has been removed'.format(revision)) from None
 
     # Execute pre-deactivate, pre-activate
-    run_script(db, old_path, site_info.name, site_info.env, revision, 'pre-deactivate')
-    run_script(db, new_path, site_info.name, site_info.env, site_info.cur_rev, 'pre-activate')
+    run_script(conn, old_path, site_info.name, site_info.env, revision, 'pre-deactivate')
+    run_script(conn, new_path, site_info.name, site_info.env, site_info.cur_rev, 'pre-activate')
 
     # Switch the symlink
-    os.symlink(new_path, new_link_name, target_is_directory=True)
-    os.replace(new_link_name, link_name)
+    replace_symlink(new_path, link_name)
 
     # Register the new deployment
-    db.execute('UPDATE deployment SET active = 0;')
-    db.execute("""
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('UPDATE deployment SET active = 0;')
+    conn.execute("""
         UPDATE deployment
           SET active = 1
           WHERE rowid = (SELECT rowid FROM deployment WHERE revision = ? ORDER BY date DESC LIMIT 1);
     """, (revision,))
+    conn.execute('COMMIT')
 
     # Execute post-deactivate, post-activate
-    run_script(db, old_path, site_info.name, site_info.env, site_info.cur_rev, 'post-deactivate')
-    run_script(db, new_path, site_info.name, site_info.env, revision, 'post-activate')
+    run_script(conn, old_path, site_info.name, site_info.env, site_info.cur_rev, 'post-deactivate')
+    run_script(conn, new_path, site_info.name, site_info.env, revision, 'post-activate')
 
     conn.commit()
-    conn.close()
+    if close_conn:
+        conn.close()
+
+
+def replace_symlink(target, link_name):
+    """
+    Atomically points a symlink to a directory.
+
+    The link is first created next to its final location with a .new suffix and then moved over the old link. A
+    leftover .new link from an earlier, interrupted run is removed first. If the link already points to the target,
+    nothing is changed.
+
+    :param target: the directory the link should point to
+    :param link_name: the path of the link
+    """
+    try:
+        if os.readlink(link_name) == target:
+            return
+    except OSError:
+        pass
+
+    new_link_name = link_name + '.new'
+
+    try:
+        os.unlink(new_link_name)
+    except FileNotFoundError:
+        pass
+
+    os.symlink(target, new_link_name, target_is_directory=True)
+    os.replace(new_link_name, link_name)
 
 
 def revert(args):
     site = args.site
 
     conn = open_site_db(args.basedir, site)
-    db = conn.cursor()
 
     rev = args.rev
     if rev is None:
-        db.execute('SELECT revision FROM deployment WHERE active <> 1 AND present = 1 ORDER BY date DESC LIMIT 1')
-
-        rev_info = db.fetchone()
+        rev_info = conn.execute(
+            'SELECT revision FROM deployment WHERE active <> 1 AND present = 1 ORDER BY date DESC LIMIT 1'
+        ).fetchone()
         if rev_info is None:
             raise Exception('No available previous deployment to revert to')
 
-        rev = rev_info['rev']
+        rev = rev_info['revision']
 
-    activate(args, site, rev)
+    activate(args, get_site_info(conn), rev, conn)
 
-    conn.commit()
     conn.close()
 
 
-def clean(args):
+def clean(args, conn=None):
     site_name = args.site
 
-    conn = open_site_db(args.basedir, site_name)
-    db = conn.cursor()
+    close_conn = conn is None
+    if close_conn:
+        conn = open_site_db(args.basedir, site_name)
 
-    site_info = get_site_info(db)
+    site_info = get_site_info(conn)
 
-    db.connection.commit()
-    db.execute("""
-        SELECT deployment.id, deployment.path, deployment.revision
+    results = conn.execute("""
+        SELECT id, path, revision
           FROM deployment
-          WHERE deployment.active <> 1
-            AND deployment.present = 1
-          ORDER BY deployment.date DESC
-          LIMIT 1000000 OFFSET 4;
-    """)
-
-    results = db.fetchall()
+          WHERE active <> 1
+            AND present = 1
+            AND id NOT IN (
+              SELECT id FROM deployment WHERE active <> 1 AND present = 1 ORDER BY date DESC LIMIT 4
+            );
+    """).fetchall()
+    if not results:
+        if close_conn:
+            conn.close()
+        return
 
     for result in results:
-        print('\033[33;1mDeleting', result['path'], '\033[0m')
+        print(YELLOW + 'Deleting', result['path'], RESET)
 
-        run_script(db, result['path'], site_info.name, site_info.env, result['revision'], 'pre-remove')
+        run_script(conn, result['path'], site_info.name, site_info.env, result['revision'], 'pre-remove')
 
-        try:
-            shutil.rmtree(result['path'])
-        except Exception:
-            pass
+    remove_trees([result['path'] for result in results])
 
-        db.execute('UPDATE deployment SET present = 0 WHERE id = ?', (result['id'],))
+    deleted_ids = [result['id'] for result in results]
 
-    conn.commit()
-    conn.close()
+    conn.execute('BEGIN')
+    conn.execute('UPDATE deployment SET present = 0 WHERE id IN ({})'.format(', '.join('?' * len(deleted_ids))),
+                 deleted_ids)
+    conn.execute('COMMIT')
+
+    if close_conn:
+        conn.close()
 
 
 def remove(args):
+    import shutil
+
     site_name = args.site
 
     # Check for administrative access
@@ -713,12 +931,34 @@ def remove(args):
 
     confirmed = prompt_bool('Are you sure you want to delete site {} at {}?'.format(site_name, site_dir))
     if not confirmed:
-        print('\033[31;1mAborted\033[0m')
+        print(RED + 'Aborted' + RESET)
         return
 
+    # Clear out the deployments concurrently first, they make up the bulk of the files.
+    deployments_dir = os.path.join(site_dir, 'deployments')
+    if os.path.isdir(deployments_dir):
+        with os.scandir(deployments_dir) as entries:
+            remove_trees([ent.path for ent in entries if ent.is_dir(follow_symlinks=False)])
+
     shutil.rmtree(site_dir)
 
 
+def remove_trees(paths):
+    """
+    Removes several directory trees concurrently.
+
+    Deleting a tree is bound by the latency of each unlink, so the trees are removed from a thread pool.
+    Errors are ignored; trees that could not be removed are left behind.
+
+    :param paths: the directories to remove
+    """
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        executor.map(lambda path: shutil.rmtree(path, ignore_errors=True), paths)
+
+
 def extract_env_args(stage):
     global args
 
@@ -739,7 +979,7 @@ def extract_env_args(stage):
     return env
 
 
-def run_script(db, deployment_path, site_name, environment, commit, stage):
+def run_script(conn, deployment_path, site_name, environment, commit, stage):
     if deployment_path is None:
         return
 
@@ -747,6 +987,8 @@ def run_script(db, deployment_path, site_name, environment, commit, stage):
     if not os.path.exists(script_path):
         return
 
+    import subprocess
+
     global args
 
     env = dict(os.environ) if args.inherit_env else {}
@@ -756,7 +998,7 @@ def run_script(db, deployment_path, site_name, environment, commit, stage):
         'DOUW_REVISION': commit,
         'DOUW_STAGE': stage
     })
-    env.update([(var['name'], var['value']) for var in get_vars(db)])
+    env.update([(var['name'], var['value']) for var in get_vars(conn)])
     env.update(extract_env_args(stage))
 
     subprocess.run([script_path], env=env, cwd=deployment_path, check=True)
@@ -764,36 +1006,33 @@ def run_script(db, deployment_path, site_name, environment, commit, stage):
 
 def var(args):
     conn = open_site_db(args.basedir, args.site)
-    db = conn.cursor()
 
     if args.var is None:
-        list_vars(db)
+        list_vars(conn)
     elif '=' in args.var:
         name, value = args.var.split('=', maxsplit=1)
-        set_var(db, name, value)
+        set_var(conn, name, value)
         conn.commit()
     else:
-        get_var(db, args.var)
+        get_var(conn, args.var)
 
     conn.close()
 
 
-def get_vars(db):
-    db.execute("SELECT variable.name, variable.value FROM variable ORDER BY variable.name")
-    return [{'name': res['name'], 'value': res['value']} for res in db.fetchall()]
+def get_vars(conn):
+    results = conn.execute("SELECT variable.name, variable.value FROM variable ORDER BY variable.name")
+    return [{'name': res['name'], 'value': res['value']} for res in results]
 
 
-def print_var_listing(lengths, var):
-    print("{:<{name_width}} | {:<{value_width}}".format(
+def print_var_listing(listing_format, var):
+    print(listing_format.format(
         var['name'],
-        var['value'],
-        name_width=lengths['name'],
-        value_width=lengths['value'],
+        var['value']
     ))
 
 
-def list_vars(db):
-    results = get_vars(db)
+def list_vars(conn):
+    results = get_vars(conn)
 
     lengths = {'name': 4, 'value': 5}
 
@@ -801,19 +1040,20 @@ def list_vars(db):
         for col in var.keys():
             lengths[col] = max(lengths[col], len(var[col] or ''))
 
-    print_var_listing(lengths, {'name': 'name', 'value': 'value'})
+    listing_format = VAR_LISTING_FORMAT.format(name_width=lengths['name'], value_width=lengths['value'])
+
+    print_var_listing(listing_format, {'name': 'name', 'value': 'value'})
 
     for var in results:
-        print_var_listing(lengths, var)
+        print_var_listing(listing_format, var)
 
 
-def set_var(db, name, value):
-    db.execute('INSERT INTO variable (name, value) VALUES (?, ?);', (name, value))
+def set_var(conn, name, value):
+    conn.execute('INSERT INTO variable (name, value) VALUES (?, ?);', (name, value))
 
 
-def get_var(db, name):
-    db.execute('SELECT variable.value FROM variable WHERE variable.name = ?', (name,))
-    var = db.fetchone()
+def get_var(conn, name):
+    var = conn.execute('SELECT variable.value FROM variable WHERE variable.name = ?', (name,)).fetchone()
 
     print(name, '=', var['value'], sep='')
 
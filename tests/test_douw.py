@@ -1,5 +1,10 @@
 import sys
 import os
+import shutil
+import subprocess
+
+import pytest
+
 from douw import douw
 
 
@@ -46,3 +51,156 @@ def test_add_and_deploy(tmpdir):
 
     assert os.path.islink(os.path.join(tmpdir, site_name, 'current'))
     assert os.path.isfile(os.path.join(tmpdir, site_name, 'current', 'index.html'))
+
+
+def test_add_from_file(tmpdir):
+    site_file = os.path.join(tmpdir, 'site.json')
+    with open(site_file, 'wt') as f:
+        f.write('{"name": "example.com", "remote": "https://example.com/site.git", "env": "T"}')
+
+    sys.argv = [
+        'douw',
+        '--basedir', str(tmpdir),
+        '-y',
+        'add',
+        '--from-file', site_file,
+        '--env', 'A'
+    ]
+    douw.main()
+
+    conn = douw.open_site_db(str(tmpdir), 'example.com')
+    site_info = douw.get_site_info(conn)
+    conn.close()
+
+    assert site_info.remote == 'https://example.com/site.git'
+    assert site_info.env == 'A'
+    assert site_info.default_treeish is None
+
+
+def add_from_file(tmpdir, contents):
+    site_file = os.path.join(tmpdir, 'site.json')
+    with open(site_file, 'wt') as f:
+        f.write(contents)
+
+    sys.argv = ['douw', '--basedir', str(tmpdir), '-y', 'add', '--from-file', site_file]
+    douw.main()
+
+
+def test_add_from_file_rejects_non_object(tmpdir):
+    with pytest.raises(Exception, match='Expected an object'):
+        add_from_file(tmpdir, '["name", "remote"]')
+
+    with pytest.raises(Exception, match='Expected an object'):
+        add_from_file(tmpdir, '"abc"')
+
+
+def test_add_from_file_rejects_unknown_property(tmpdir):
+    with pytest.raises(Exception, match='Unknown site properties'):
+        add_from_file(tmpdir, '{"name": "example.com", "bogus": "x"}')
+
+
+def test_add_from_file_rejects_non_string_value(tmpdir):
+    with pytest.raises(Exception, match='must be strings or null'):
+        add_from_file(tmpdir, '{"name": 1, "remote": "https://example.com/site.git"}')
+
+    assert not os.path.exists(os.path.join(tmpdir, '1'))
+
+
+def test_list_renamed_site(tmpdir, capsys):
+    test_add_new(tmpdir)
+
+    sys.argv = ['douw', '--basedir', str(tmpdir), 'edit', 'example.com', '--name', 'renamed.example.com']
+    douw.main()
+
+    sys.argv = ['douw', '--basedir', str(tmpdir), 'list', '--site', 'renamed.*']
+    capsys.readouterr()
+    douw.main()
+
+    assert 'renamed.example.com' in capsys.readouterr().out
+
+
+def test_clean_keeps_newest_deployments(tmpdir):
+    site_name = 'example.com'
+    os.makedirs(os.path.join(tmpdir, site_name))
+
+    conn = douw.create_site_db(str(tmpdir), site_name)
+    conn.execute("INSERT INTO site (name, remote, env) VALUES (?, 'https://example.com/site.git', 'P')", (site_name,))
+
+    # (date, active, present)
+    deployments = [(1, 0, 1), (2, 0, 1), (3, 0, 0), (4, 0, 1), (5, 1, 1), (6, 0, 1), (7, 0, 1), (8, 0, 1)]
+    for date, active, present in deployments:
+        path = os.path.join(tmpdir, site_name, 'deployments', str(date))
+        if present:
+            os.makedirs(path)
+
+        conn.execute('INSERT INTO deployment (path, revision, date, active, present) VALUES (?, ?, ?, ?, ?)',
+                     (path, 'rev{}'.format(date), date, active, present))
+
+    conn.commit()
+    conn.close()
+
+    sys.argv = ['douw', '--basedir', str(tmpdir), 'clean', site_name]
+    douw.main()
+
+    conn = douw.open_site_db(str(tmpdir), site_name)
+    remaining = [row['date'] for row in conn.execute('SELECT date FROM deployment WHERE present = 1 ORDER BY date')]
+    conn.close()
+
+    assert remaining == [4, 5, 6, 7, 8]
+    assert sorted(os.listdir(os.path.join(tmpdir, site_name, 'deployments'))) == ['4', '5', '6', '7', '8']
+
+
+def test_migrate_version_1_database(tmpdir):
+    site_name = 'example.com'
+    os.makedirs(os.path.join(tmpdir, site_name))
+    shutil.copyfile(os.path.join(os.path.dirname(__file__), 'test.db'), douw.get_site_db(str(tmpdir), site_name))
+
+    conn = douw.open_site_db(str(tmpdir), site_name)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    objects = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'index')")}
+    conn.close()
+
+    assert version == douw.SCHEMA_VERSION
+    assert 'variable' in objects
+    assert 'idx_deployment_active_present_date' in objects
+
+
+def git(repo_dir, *args):
+    result = subprocess.run(['git', '-c', 'user.name=douw', '-c', 'user.email=douw@example.com', *args],
+                            cwd=repo_dir, stdout=subprocess.PIPE, check=True)
+    return result.stdout.decode('utf8').strip()
+
+
+def test_read_head_packed_and_detached(tmpdir, monkeypatch):
+    repo_dir = str(tmpdir)
+    git(repo_dir, 'init', '-q')
+    with open(os.path.join(repo_dir, 'index.html'), 'wt') as f:
+        f.write('one')
+    git(repo_dir, 'add', 'index.html')
+    git(repo_dir, 'commit', '-q', '-m', 'one')
+    first = git(repo_dir, 'rev-parse', 'HEAD')
+    branch = git(repo_dir, 'symbolic-ref', '--short', 'HEAD')
+
+    with open(os.path.join(repo_dir, 'index.html'), 'wt') as f:
+        f.write('two')
+    git(repo_dir, 'commit', '-q', '-a', '-m', 'two')
+
+    # The branch ref only exists in packed-refs
+    git(repo_dir, 'pack-refs', '--all')
+    second = git(repo_dir, 'rev-parse', 'HEAD')
+
+    git(repo_dir, 'checkout', '-q', '--detach', first)
+    detached = git(repo_dir, 'rev-parse', 'HEAD')
+    git(repo_dir, 'checkout', '-q', branch)
+    assert not os.path.exists(os.path.join(repo_dir, '.git', 'refs', 'heads', branch))
+
+    # Make sure the refs are read from the files instead of falling back to git
+    with monkeypatch.context() as patch:
+        patch.setattr(subprocess, 'run', None)
+        assert douw.read_head(repo_dir) == second
+
+    # A detached HEAD holds the commit itself
+    git(repo_dir, 'checkout', '-q', '--detach', first)
+    with monkeypatch.context() as patch:
+        patch.setattr(subprocess, 'run', None)
+        assert douw.read_head(repo_dir) == detached == first